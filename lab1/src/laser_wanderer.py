@@ -7,6 +7,12 @@ import sys
 
 import utils
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+from rospy.numpy_msg import numpy_msg
 from sensor_msgs.msg import LaserScan
 from ackermann_msgs.msg import AckermannDriveStamped
 from geometry_msgs.msg import PoseStamped, PoseArray, Pose
@@ -19,6 +25,8 @@ VIZ_TOPIC = '/laser_wanderer/rollouts'                          # The topic to p
                                                                 # the computed rollouts. Publish a PoseArray.
 MAX_PENALTY = 10000                                             # The penalty to apply when a configuration in a rollout
                                                                 # goes beyond the corresponding laser scan
+GPU_MIN_ROLLOUTS = 256                                          # Generate the rollouts on the GPU (if available) when there
+                                                                # are at least this many of them
 
 '''
 Wanders around using minimum (steering angle) control effort while avoiding crashing
@@ -37,19 +45,82 @@ class LaserWanderer:
     speed:          The speed at which the car should travel
     compute_time:   The amount of time (in seconds) we can spend computing the cost
     laser_offset:   How much to shorten the laser measurements
+    cost_kernel:    Which implementation computes the trajectory costs. One of 'numba',
+                    'cython', 'numpy' or 'auto' (numba if it is installed, else numpy)
     '''
-    def __init__(self, rollouts, deltas, speed, compute_time, laser_offset):
+    def __init__(self, rollouts, deltas, speed, compute_time, laser_offset, cost_kernel='auto'):
         # Store the params for later
-        self.rollouts = rollouts
         self.deltas = deltas
         self.speed = speed
         self.compute_time = compute_time
         self.laser_offset = laser_offset
 
+        # Store the rollouts as separate NxT float32 arrays of x, y and theta, so the cost
+        # computation reads contiguous memory and moves half as many bytes
+        self.rx = np.ascontiguousarray(rollouts[:,:,0], dtype=np.float32)
+        self.ry = np.ascontiguousarray(rollouts[:,:,1], dtype=np.float32)
+        self.rtheta = np.ascontiguousarray(rollouts[:,:,2], dtype=np.float32)
+
+        # The per-pose quantities used by the cost computation only depend on the
+        # rollouts, so compute them once here instead of on every scan
+        self.pose_dist = np.sqrt(self.rx**2 + self.ry**2)
+        self.rollout_angles = np.arctan2(self.ry, self.rx)
+        self.abs_deltas = np.abs(deltas)
+
+        # Every step of a trajectory pays |delta|, so over T steps the steering part of
+        # its cost is a constant
+        self.steering_costs = self.abs_deltas * self.rx.shape[1]
+
+        # The laser ray that corresponds to each rollout pose, and which poses are outside
+        # of the scan's field of view. Filled in by update_scan_geometry
+        self.scan_geometry = None
+        self.rollout_idx = None
+        self.out_of_fov = None
+
+        # Pick the implementation of the cost computation. The parallel numba kernel is
+        # preferred, the Cython one is serial and only used when asked for
+        if cost_kernel not in ('auto', 'numba', 'cython', 'numpy'):
+            rospy.logwarn('Unknown cost_kernel %r, expected auto, numba, cython or numpy. '
+                          'Computing costs with numpy' % (cost_kernel,))
+            cost_kernel = 'numpy'
+        if cost_kernel == 'auto':
+            cost_kernel = 'numba' if numba is not None else 'numpy'
+        if cost_kernel == 'numba' and numba is None:
+            rospy.logwarn('numba is not installed, computing costs with numpy')
+            cost_kernel = 'numpy'
+
+        self.cython_kernel = None
+        if cost_kernel == 'cython':
+            try:
+                self.cython_kernel = load_cython_kernel()
+            except ImportError as e:
+                rospy.logwarn('Could not load the Cython kernel (%s), computing costs with numpy' % e)
+
+        # Run the numba kernel once on data of the real shape to start its threads, so
+        # the first laser scan doesn't wait on it
+        self.cost_kernel = None
+        if cost_kernel == 'numba':
+            self.cost_kernel = _compute_delta_costs
+            self.cost_kernel(np.ones(self.rx.shape, dtype=np.int32), np.zeros(self.rx.shape, dtype=np.bool_),
+                             self.pose_dist, self.steering_costs, np.zeros(3, dtype=np.float32),
+                             0.0, MAX_PENALTY)
+
+        # The PoseArray for vizualization. Will contain N poses, where the n-th pose
+        # represents the last pose in the n-th trajectory. The rollouts are fixed and
+        # expressed in the car's frame, so only the timestamp changes between publishes
+        self.viz_pa = PoseArray()
+        self.viz_pa.header.frame_id = '/car/base_link'
+        for x, y, theta in zip(self.rx[:,-1], self.ry[:,-1], self.rtheta[:,-1]):
+            pose = Pose()
+            pose.position.x = float(x)
+            pose.position.y = float(y)
+            pose.orientation = utils.angle_to_quaternion(float(theta))
+            self.viz_pa.poses.append(pose)
+
         # YOUR CODE HERE
         # NOTE THAT THIS VIZUALIZATION WILL ONLY WORK IN SIMULATION.
         self.cmd_pub = rospy.Publisher(CMD_TOPIC, AckermannDriveStamped, queue_size=1)          # Create a publisher for sending controls
-        self.laser_sub = rospy.Subscriber(SCAN_TOPIC, LaserScan, self.wander_cb, queue_size=1)  # Create a subscriber to laser scans that uses the self.wander_cb callback
+        self.laser_sub = rospy.Subscriber(SCAN_TOPIC, numpy_msg(LaserScan), self.wander_cb, queue_size=1)  # Create a subscriber to laser scans that uses the self.wander_cb callback. numpy_msg gives the ranges as a float32 array
         self.viz_pub = rospy.Publisher(VIZ_TOPIC, PoseArray, queue_size=1)                      # Create a publisher for vizualizing trajectories. Will publish PoseArrays  
         self.viz_sub = rospy.Subscriber(POSE_TOPIC, PoseStamped, self.viz_sub_cb, queue_size=1) # Create a subscriber to the current position of the car
     
@@ -59,23 +130,8 @@ class LaserWanderer:
     msg: A PoseStamped representing the current pose of the car
     '''
     def viz_sub_cb(self, msg):
-        # Create the PoseArray to publish. Will contain N poses, where the n-th pose
-        # represents the last pose in the n-th trajectory
-        pa = PoseArray()
-        pa.header.frame_id = '/car/base_link'
-        pa.header.stamp = rospy.Time.now()
-
-        # Transform the last pose of each trajectory to be w.r.t the world and insert into
-        # the pose array
-        
-        for node in self.rollouts:
-            pose = Pose()
-            pose.position.x = node[-1,0]
-            pose.position.y = node[-1,1]
-            m =node[-1,2]
-            pose.orientation = utils.angle_to_quaternion(m)
-            pa.poses.append(pose)
-        self.viz_pub.publish(pa)
+        self.viz_pa.header.stamp = rospy.Time.now()
+        self.viz_pub.publish(self.viz_pa)
     
     '''
     Compute the cost of one step in the trajectory. It should penalize the magnitude
@@ -100,51 +156,115 @@ class LaserWanderer:
         #   What if the corresponding laser measurement is NAN?
         # NOTE THAT NO COORDINATE TRANSFORMS ARE NECESSARY INSIDE OF THIS FUNCTION
 
-        cost = np.abs(delta)
+        cost = abs(delta)
 
         angle = math.atan2(rollout_pose[1], rollout_pose[0])
 
-        laser_distance0 = laser_msg.ranges[int(round((angle-laser_msg.angle_min)/laser_msg.angle_increment))]
-        laser_distance1 = laser_msg.ranges[int(round((angle-laser_msg.angle_min)/laser_msg.angle_increment))+1]
-        laser_distance2 = laser_msg.ranges[int(round((angle-laser_msg.angle_min)/laser_msg.angle_increment))-1]
-        
-        pose_distance = math.pow(rollout_pose[0],2) + math.pow(rollout_pose[1],2)
+        # The scan can't tell us whether a pose outside of its field of view is free, so
+        # penalize it as if it went beyond the scan. angle_min is greater than angle_max
+        # when the scan goes clockwise (negative angle_increment)
+        fov_min, fov_max = sorted((laser_msg.angle_min, laser_msg.angle_max))
+        if angle < fov_min or angle > fov_max:
+            return cost + MAX_PENALTY
 
-        if pose_distance > (laser_distance0 - np.abs(self.laser_offset)):
-            cost = cost + MAX_PENALTY
-        if pose_distance > (laser_distance1 - np.abs(self.laser_offset)):
-            cost = cost + MAX_PENALTY
-        if pose_distance > (laser_distance2 - np.abs(self.laser_offset)):
-            cost = cost + MAX_PENALTY
+        idx = int(round((angle-laser_msg.angle_min)/laser_msg.angle_increment))
+        idx = min(max(idx, 1), len(laser_msg.ranges) - 2)
 
-        cost = cost / 3
+        pose_distance = math.sqrt(rollout_pose[0]*rollout_pose[0] + rollout_pose[1]*rollout_pose[1])
+        offset = abs(self.laser_offset)
+
+        # The pose goes beyond the scan if it goes beyond the ray at idx or either of
+        # its two neighbours
+        if any(pose_distance > (laser_distance - offset) for laser_distance in laser_msg.ranges[idx-1:idx+2]):
+            cost = cost + MAX_PENALTY
 
         return cost
-    
+
     '''
-    Controls the steering angle in response to the received laser scan. Uses approximately
-    self.compute_time amount of time to compute the control
-    msg: A LaserScan
+    Find the laser ray that corresponds to each rollout pose. This only depends on the
+    angles covered by the scan, so it is only recomputed when those change
+    laser_msg: The most recent laser scan
     '''
-    def wander_cb(self, msg):
-        start = rospy.Time.now().to_sec()   # Get the time at which this function started
+    def update_scan_geometry(self, laser_msg):
+        geometry = (laser_msg.angle_min, laser_msg.angle_max, laser_msg.angle_increment, len(laser_msg.ranges))
+        if geometry == self.scan_geometry:
+            return
+        self.scan_geometry = geometry
+
+        # The i-th ray covers the angles between the (i-1)-th and i-th edges, so searching
+        # the edges gives the nearest ray without dividing and rounding every angle
+        L = len(laser_msg.ranges)
+        angle_edges = laser_msg.angle_min + (np.arange(L) + 0.5) * laser_msg.angle_increment
+        if laser_msg.angle_increment > 0:
+            idx = np.searchsorted(angle_edges, self.rollout_angles)
+        else:
+            # The edges descend when the scan goes clockwise, so search them in ascending
+            # order and map the result back to the ray index
+            idx = L - np.searchsorted(angle_edges[::-1], self.rollout_angles)
+        self.rollout_idx = np.clip(idx, 1, L - 2).astype(np.int32)
+        # angle_min is greater than angle_max when the scan goes clockwise
+        fov_min, fov_max = sorted((laser_msg.angle_min, laser_msg.angle_max))
+        self.out_of_fov = (self.rollout_angles < fov_min) | (self.rollout_angles > fov_max)
 
-        # A N dimensional matrix that should be populated with the costs of each
-        # trajectory up to time t <= T
-        delta_costs = np.zeros(self.deltas.shape[0], dtype=np.float) 
-        traj_depth = 0
-        
-        # Evaluate the cost of each trajectory. Each iteration of the loop should calculate
-        # the cost of each trajectory at time t = traj_depth and add those costs to delta_costs
-        # as appropriate
+    '''
+    Compute the cost of every trajectory at once. Gives the same result as summing
+    compute_cost over all T poses of each of the N rollouts. update_scan_geometry
+    must have been called with the scan that ranges came from
+    ranges: The laser scan ranges as a numpy array
+    Returns an N dimensional array containing the cost of each trajectory
+    '''
+    def compute_delta_costs(self, ranges):
+        # A pose goes beyond the scan if it goes beyond any of the three rays around it, so
+        # take the minimum over each window of three rays once and compare against that
+        offset = np.abs(self.laser_offset)
+        window_min = np.minimum(np.minimum(ranges[:-2], ranges[1:-1]), ranges[2:])
+        collisions = self.pose_dist > (window_min[self.rollout_idx-1] - offset)
 
-        while (rospy.Time.now().to_sec() < (start + self.compute_time)):
-            for n in xrange(self.deltas.shape[0]):
-                for traj_depth in xrange(self.rollouts.shape[1]):
-                    delta_costs[n] += self.compute_cost(self.deltas[n],self.rollouts[n,traj_depth,:],msg)
+        # Poses outside of the scan's field of view count as going beyond it
+        collisions |= self.out_of_fov
 
-        # Find the delta that has the smallest cost and execute it by publishing
-        chosen_delta = np.argmin(delta_costs)
+        return self.steering_costs + MAX_PENALTY * collisions.sum(axis=1)
+
+    '''
+    Controls the steering angle in response to the received laser scan. The cost of
+    every trajectory is evaluated in a single pass, which fits well within
+    self.compute_time
+    msg: A LaserScan
+    '''
+    def wander_cb(self, msg):
+        # Evaluate the cost of each trajectory over all T of its poses. The rollouts and
+        # the scan do not change within this callback, so one evaluation is enough
+        if isinstance(msg.ranges, np.ndarray):
+            # The subscriber uses numpy_msg, which already gives a float32 array, so this
+            # doesn't copy it
+            ranges = np.asarray(msg.ranges, dtype=np.float32)
+        else:
+            # A plain LaserScan gives the ranges as a tuple
+            ranges = np.fromiter(msg.ranges, dtype=np.float32, count=len(msg.ranges))
+
+        # A NaN measurement means the ray did not hit anything, so treat it as infinitely far
+        # away. Comparisons against it then never add a penalty. Only copy the ranges when
+        # there is something to replace, as they may be a view into the message
+        nans = np.isnan(ranges)
+        if nans.any():
+            ranges = np.where(nans, np.float32(np.inf), ranges)
+
+        self.update_scan_geometry(msg)
+        if self.cython_kernel is not None:
+            delta_costs = np.empty(self.deltas.shape[0], dtype=np.float64)
+            self.cython_kernel(self.rollout_idx, self.out_of_fov.view(np.uint8), self.pose_dist,
+                              self.steering_costs, ranges, np.abs(self.laser_offset),
+                              MAX_PENALTY, delta_costs)
+        elif self.cost_kernel is not None:
+            delta_costs = self.cost_kernel(self.rollout_idx, self.out_of_fov, self.pose_dist,
+                                           self.steering_costs, ranges, np.abs(self.laser_offset),
+                                           MAX_PENALTY)
+        else:
+            delta_costs = self.compute_delta_costs(ranges)
+
+        # Find the delta that has the smallest cost and execute it by publishing. Ties go
+        # to the delta with the smallest magnitude, i.e. the one closest to driving straight
+        chosen_delta = int(np.lexsort((self.abs_deltas, delta_costs))[0])
 
         # Setup the control message
         ads = AckermannDriveStamped()
@@ -155,6 +275,51 @@ class LaserWanderer:
 
         # Publish the 
         self.cmd_pub.publish(ads)
+
+'''
+Import the Cython version of LaserWanderer.compute_delta_costs. If laser_wanderer_kernels
+hasn't been built ahead of time (e.g. with cythonize -i laser_wanderer_kernels.pyx), it is
+built with pyximport, which needs Cython and a C compiler and takes a while the first time
+Returns compute_delta_costs_c from laser_wanderer_kernels
+'''
+def load_cython_kernel():
+  try:
+    from laser_wanderer_kernels import compute_delta_costs_c
+  except ImportError:
+    import pyximport
+    pyximport.install()
+    from laser_wanderer_kernels import compute_delta_costs_c
+  return compute_delta_costs_c
+
+'''
+Compiled version of LaserWanderer.compute_delta_costs, only available when numba is
+installed. It is a generalized ufunc that computes the cost of one trajectory, numba
+broadcasts it over the N trajectories and splits them across threads. It is compiled
+when this module is imported and cached on disk, so later starts of the node load it
+instead of compiling it again
+  rollout_idx: T dimensional array with the laser ray that corresponds to each pose
+  out_of_fov: T dimensional boolean array marking the poses outside of the scan's
+              field of view
+  pose_dist: T dimensional array with the distance of each pose from the car
+  steering_cost: The steering part of the trajectory's cost
+  ranges: The laser scan ranges as a float32 numpy array
+  offset: How much to shorten the laser measurements
+  penalty: The penalty to apply for each pose that goes beyond the laser scan
+  cost: Output, the cost of the trajectory
+'''
+if numba is not None:
+  # fastmath without the nnan/ninf flags, laser scans can contain inf
+  @numba.guvectorize(['void(i4[:], b1[:], f4[:], f8, f4[:], f8, f8, f8[:])'],
+                     '(t),(t),(t),(),(m),(),()->()', target='parallel', nopython=True,
+                     fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'}, cache=True)
+  def _compute_delta_costs(rollout_idx, out_of_fov, pose_dist, steering_cost, ranges, offset, penalty, cost):
+    total = steering_cost
+    for t in range(rollout_idx.shape[0]):
+      i = rollout_idx[t]
+      if out_of_fov[t] or pose_dist[t] > min(ranges[i-1], ranges[i], ranges[i+1]) - offset:
+        total += penalty
+    cost[0] = total
+
 '''
 Apply the kinematic model to the passed pose and control
   pose: The current state of the robot [x, y, theta]
@@ -177,13 +342,10 @@ def kinematic_model_step(pose, control, car_length):
     dx = (car_length/sin2beta)*(np.sin(theta+dtheta)-np.sin(theta))
     dy = (car_length/sin2beta)*(-1*np.cos(theta+dtheta)+np.cos(theta))
    
-  while theta + dtheta > 2*np.pi:
-    dtheta -= 2*np.pi
-   
-  while theta + dtheta < 2*np.pi:
-    dtheta += 2*np.pi
-   
-  return np.array([x+dx, y+dy, theta+dtheta], dtype=np.float)
+  # Keep theta within [0, 2*pi)
+  new_theta = (theta + dtheta) % (2*np.pi)
+
+  return np.array([x+dx, y+dy, new_theta], dtype=np.float)
     
 '''
 Repeatedly apply the kinematic model to produce a trajectory for the car
@@ -217,23 +379,58 @@ Helper function to generate a number of kinematic car rollouts
 Returns a NxTx3 numpy array that contains N rolled out trajectories, each
 containing T poses. For each trajectory, the t-th element represents the [x,y,theta]
 pose of the car at time t+1
+When cupy and a GPU are available and N >= GPU_MIN_ROLLOUTS, the trajectories are
+generated on the GPU and copied back once at the end
 '''
 def generate_mpc_rollouts(speed, min_delta, max_delta, delta_incr, dt, T, car_length):
 
     deltas = np.arange(min_delta, max_delta, delta_incr)
     N = deltas.shape[0]
 
-    init_pose = np.array([0.0,0.0,0.0], dtype=np.float)
+    # Pick the array module to run the kinematics with. numpy and cupy share the same API.
+    # Only look for cupy and a GPU when there are enough rollouts, so small runs don't
+    # pay for creating a CUDA context
+    xp = np
+    if N >= GPU_MIN_ROLLOUTS:
+        try:
+            import cupy
+            cupy.cuda.runtime.getDeviceCount()
+            xp = cupy
+        except Exception:
+            pass
+
+    rollouts = xp.zeros((N,T,3), dtype=np.float)
+
+    # Apply the kinematic model to all N trajectories at once, one time step at a time.
+    # Each trajectory starts at [0,0,0]
+    x = xp.zeros(N, dtype=np.float)
+    y = xp.zeros(N, dtype=np.float)
+    theta = xp.zeros(N, dtype=np.float)
+
+    # The speed and steering angle are constant along a trajectory, so these are too
+    steering = xp.asarray(deltas)
+    straight = xp.abs(steering) < 1e-2
+    beta = xp.arctan(0.5*xp.tan(steering))
+    sin2beta = xp.where(straight, 1.0, xp.sin(2*beta))     # Unused when driving straight, avoids dividing by 0
+    dtheta = xp.where(straight, 0.0, ((speed/car_length) * sin2beta) * dt)
+
+    for t in xrange(T):
+        new_theta = theta + dtheta
+        dx = xp.where(straight, speed*xp.cos(theta)*dt,
+                      (car_length/sin2beta)*(xp.sin(new_theta)-xp.sin(theta)))
+        dy = xp.where(straight, speed*xp.sin(theta)*dt,
+                      (car_length/sin2beta)*(-1*xp.cos(new_theta)+xp.cos(theta)))
+        x += dx
+        y += dy
+        theta = xp.mod(new_theta, 2*np.pi)     # Keep theta within [0, 2*pi)
+
+        rollouts[:,t,0] = x
+        rollouts[:,t,1] = y
+        rollouts[:,t,2] = theta
+
+    if xp is not np:
+        rollouts = xp.asnumpy(rollouts)
 
-    rollouts = np.zeros((N,T,3), dtype=np.float)
-    
-    for i in xrange(N):
-        controls = np.zeros((T,3), dtype=np.float)
-        controls[:,0] = speed
-        controls[:,1] = deltas[i]
-        controls[:,2] = dt
-        rollouts[i,:,:] = generate_rollout(init_pose, controls, car_length, T)
-    
     return rollouts, deltas
 
 def main():
@@ -256,6 +453,7 @@ def main():
     T = rospy.get_param("~T", 300)				            # Starting val: 300
     compute_time = rospy.get_param("~compute_time", 0.09)	# Default val: 0.09
     laser_offset = rospy.get_param("~laser_offset", 1.0)	# Starting val: 1.0
+    cost_kernel = rospy.get_param("~cost_kernel", "auto")  # Default val: auto
 
     # DO NOT ADD THIS TO YOUR LAUNCH FILE, car_length is already provided by teleop.launch
     car_length = rospy.get_param("car_kinematics/car_length", 0.33)
@@ -265,7 +463,7 @@ def main():
     rollouts, deltas = generate_mpc_rollouts(speed, min_delta, max_delta, delta_incr, dt, T, car_length)
 
     # Create the LaserWanderer                                         
-    lw = LaserWanderer(rollouts, deltas, speed, compute_time, laser_offset)
+    lw = LaserWanderer(rollouts, deltas, speed, compute_time, laser_offset, cost_kernel)
 
     # Keep the node alive
     rospy.spin()
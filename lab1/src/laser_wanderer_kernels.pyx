@@ -0,0 +1,49 @@
+# cython: language_level=2
+
+cimport cython
+
+'''
+Cython version of LaserWanderer.compute_delta_costs. Unlike the numba kernel it is
+compiled ahead of time, so the first laser scan does not pay for a JIT compile
+  rollout_idx: NxT int32 array with the laser ray that corresponds to each rollout pose
+  out_of_fov: NxT uint8 array marking the poses outside of the scan's field of view
+  pose_dist: NxT float32 array with the distance of each rollout pose from the car
+  steering_costs: N dimensional array with the steering part of each trajectory's cost
+  ranges: The laser scan ranges as a float32 numpy array
+  offset: How much to shorten the laser measurements
+  penalty: The penalty to apply for each pose that goes beyond the laser scan
+  out: N dimensional array that is filled with the cost of each trajectory
+'''
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def compute_delta_costs_c(const int[:, ::1] rollout_idx, const unsigned char[:, ::1] out_of_fov,
+                          const float[:, ::1] pose_dist, const double[::1] steering_costs,
+                          const float[::1] ranges, float offset, double penalty, double[::1] out):
+    cdef Py_ssize_t N = rollout_idx.shape[0]
+    cdef Py_ssize_t T = rollout_idx.shape[1]
+    cdef Py_ssize_t n, t
+    cdef int i
+    cdef float window_min
+    cdef double cost
+
+    with nogil:
+        for n in range(N):
+            cost = steering_costs[n]
+            for t in range(T):
+                if out_of_fov[n, t]:
+                    cost += penalty
+                    continue
+
+                # The pose goes beyond the scan if it goes beyond any of the three rays
+                # around it
+                i = rollout_idx[n, t]
+                window_min = ranges[i-1]
+                if ranges[i] < window_min:
+                    window_min = ranges[i]
+                if ranges[i+1] < window_min:
+                    window_min = ranges[i+1]
+
+                if pose_dist[n, t] > window_min - offset:
+                    cost += penalty
+            out[n] = cost